@@ -134,6 +134,7 @@ if __name__ == "__main__":
     parser.add_argument('--time-offset', type=int, default=0)
     parser.add_argument('--cuda_idx', help='gpu to use ', type=int, default=0)
     parser.add_argument('--max-grad-norm', type=float, default=10., help='Max Grad Norm')
+    parser.add_argument('--amp', type=int, default=0, help='Use bf16 autocast for the loss forwards')
     parser.add_argument('--skip_init_eval', action='store_true', help='no initial evaluation')
 
     # model
@@ -1,11 +1,12 @@
 import torch
+import torch.nn.functional as F
 import pdb
+from concurrent.futures import ThreadPoolExecutor
 
 from rlpyt.utils.collections import namedarraytuple
 from collections import namedtuple
 from rlpyt.algos.dqn.cat_dqn import CategoricalDQN
-from rlpyt.utils.tensor import select_at_indexes, valid_mean
-from rlpyt.algos.utils import valid_from_done
+from rlpyt.utils.tensor import select_at_indexes
 from rlpyt.utils.logging import logger
 from src.rlpyt_buffer import AsyncPrioritizedSequenceReplayFrameBufferExtended, \
     AsyncUniformSequenceReplayFrameBufferExtended
@@ -27,6 +28,26 @@ ModelOptInfo = namedtuple("OptInfo", ["loss", "gradNorm",
 EPS = 1e-6  # (NaN-guard)
 
 
+@torch.jit.script
+def c51_projection(target_p_unproj: torch.Tensor, next_z: torch.Tensor,
+                   V_min: float, delta_z: float, n_atoms: int) -> torch.Tensor:
+    """Two-bucket C51 projection of the backed-up distribution onto the fixed
+    support; scripted so the pointwise chain fuses into one kernel."""
+    b = (next_z - V_min) / delta_z  # [B,P']
+    # Clamp before using as scatter indexes: fp roundoff in delta_z can
+    # push b fractionally past n_atoms - 1 and ceil out of bounds.
+    l = b.floor().long().clamp(0, n_atoms - 1)
+    u = b.ceil().long().clamp(0, n_atoms - 1)
+    # When b lands exactly on an atom, l == u and its mass would be
+    # dropped; nudge one bucket so the weights still sum to 1.
+    l = l - ((u > 0) & (l == u)).long()
+    u = u + ((l == u) & (l < n_atoms - 1)).long()
+    target_p = torch.zeros_like(target_p_unproj)  # [B,P]
+    target_p.scatter_add_(1, l, target_p_unproj * (u.float() - b))
+    target_p.scatter_add_(1, u, target_p_unproj * (b - l.float()))
+    return target_p
+
+
 class SPRCategoricalDQN(CategoricalDQN):
     """Distributional DQN with fixed probability bins for the Q-value of each
     action, a.k.a. categorical."""
@@ -40,6 +61,7 @@ class SPRCategoricalDQN(CategoricalDQN):
                  time_offset=0,
                  distributional=1,
                  jumps=0,
+                 amp=0,
                  **kwargs):
         super().__init__(**kwargs)
         self.opt_info_fields = tuple(f for f in ModelOptInfo._fields)  # copy
@@ -51,6 +73,7 @@ class SPRCategoricalDQN(CategoricalDQN):
         self.model_rl_weight = model_rl_weight
         self.time_offset = time_offset
         self.jumps = jumps
+        self.amp = amp
 
         if not distributional:
             self.rl_loss = self.dqn_rl_loss
@@ -99,9 +122,59 @@ class SPRCategoricalDQN(CategoricalDQN):
             self.model = self.agent.model
         if self.initial_optim_state_dict is not None:
             self.optimizer.load_state_dict(self.initial_optim_state_dict)
+        # Cache the categorical value support; rebuilding these tensors on
+        # every minibatch is pure overhead on the loss path.
+        self._z = torch.linspace(self.V_min, self.V_max, self.agent.n_atoms)
+        self._delta_z = (self.V_max - self.V_min) / (self.agent.n_atoms - 1)
+        self._next_z_scale = self.discount ** self.n_step_return
+        self._next_z = self._z * self._next_z_scale  # [P']
+        # Single worker which walks the replay buffer (sum-tree sampling plus
+        # sequence extraction) while the previous minibatch trains.
+        self._sample_executor = ThreadPoolExecutor(max_workers=1)
+        # Side stream for running the next batch's target forward under the
+        # current update's backward/step kernels.
+        self._target_stream = (torch.cuda.Stream()
+                               if torch.cuda.is_available() else None)
+        if hasattr(torch, "compile") and not getattr(self, "_rl_loss_compiled", False):
+            # Fuses the remaining pointwise chains in the loss; dynamo falls
+            # back to eager around the pieces it cannot capture (the samples
+            # namedarraytuple and the .cpu() syncs inside the agent calls).
+            self.rl_loss = torch.compile(self.rl_loss)
+            self._rl_loss_compiled = True
         if self.prioritized_replay:
             self.pri_beta_itr = max(1, self.pri_beta_steps // self.sampler_bs)
 
+    def autocast(self):
+        """bf16 autocast for the network forwards in the loss; the categorical
+        distributions are bounded probabilities, so no grad scaling needed."""
+        return torch.autocast("cuda", dtype=torch.bfloat16,
+                              enabled=bool(self.amp))
+
+    @property
+    def n_target_steps(self):
+        """Time steps needing a backed-up target: t=0, plus the jump steps
+        when the model RL loss is on."""
+        return self.jumps + 1 if self.model_rl_weight > 0 else 1
+
+    def target_inputs(self, samples):
+        """Next-state inputs for all target steps, folded into one batch.
+        The steps are a contiguous time range, so a slice+flatten replaces
+        a per-index gather and concat."""
+        steps = slice(self.n_step_return,
+                      self.n_step_return + self.n_target_steps)
+        return (samples.all_observation[steps].flatten(0, 1),
+                samples.all_action[steps].flatten(0, 1),
+                samples.all_reward[steps].flatten(0, 1))
+
+    def compute_targets(self, samples):
+        """Batched target-network forward for all target steps: one launch
+        instead of jumps+1.  Reads only target weights, so it can also run
+        ahead of the optimizer step, e.g. on a side CUDA stream."""
+        target_obs, target_act, target_rew = self.target_inputs(samples)
+        with torch.no_grad(), self.autocast():
+            target_ps = self.agent.target(target_obs, target_act, target_rew)
+        return target_ps.view(self.n_target_steps, -1, *target_ps.shape[1:])
+
     def samples_to_buffer(self, samples):
         """Defines how to add data from sampler into the replay buffer. Called
         in optimize_agent() if samples are provided to that method.  In
@@ -129,17 +202,24 @@ class SPRCategoricalDQN(CategoricalDQN):
         opt_info = ModelOptInfo(*([] for _ in range(len(ModelOptInfo._fields))))
         if itr < self.min_itr_learn:
             return opt_info
-        for _ in range(self.updates_per_optimize):
-            samples_from_replay = self.replay_buffer.sample_batch(self.batch_size)
+        sample_future = self._sample_executor.submit(
+            self.replay_buffer.sample_batch, self.batch_size)
+        next_samples = next_targets = None
+        for i in range(self.updates_per_optimize):
+            samples_from_replay = (sample_future.result()
+                                   if next_samples is None else next_samples)
+            target_ps = next_targets
+            next_samples = next_targets = None
 
             loss, td_abs_errors, model_rl_loss, reward_loss,\
-            t0_spr_loss, model_spr_loss, pred_l2_loss = self.loss(samples_from_replay)
+            t0_spr_loss, model_spr_loss, pred_l2_loss = self.loss(samples_from_replay,
+                                                                  target_ps)
             spr_loss = self.t0_spr_loss_weight*t0_spr_loss + self.model_spr_weight*model_spr_loss
             spr_loss += pred_l2_loss * self.pred_decay
             total_loss = loss + self.model_rl_weight*model_rl_loss \
                               + self.reward_loss_weight*reward_loss
             total_loss = total_loss + spr_loss
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             total_loss.backward()
             grad_norm = torch.nn.utils.clip_grad_norm_(
                 self.model.stem_parameters(), self.clip_grad_norm)
@@ -148,24 +228,54 @@ class SPRCategoricalDQN(CategoricalDQN):
                     self.model.dynamics_model.parameters(), self.clip_grad_norm)
             else:
                 model_grad_norm = 0
-            self.optimizer.step()
             if self.prioritized_replay:
+                # Must complete before the next sample_batch is submitted:
+                # update_batch_priorities writes to the tree leaves recorded
+                # by the most recent sample(), so an in-flight sample would
+                # both race the tree arrays and redirect this write to the
+                # wrong transitions.
                 self.replay_buffer.update_batch_priorities(td_abs_errors)
-            opt_info.loss.append(loss.item())
-            opt_info.gradNorm.append(torch.tensor(grad_norm).item())  # grad_norm is a float sometimes, so wrap in tensor
-            opt_info.modelRLLoss.append(model_rl_loss.item())
-            opt_info.RewardLoss.append(reward_loss.item())
-            opt_info.modelGradNorm.append(torch.tensor(model_grad_norm).item())
-            opt_info.SPRLoss.append(spr_loss.item())
-            opt_info.ModelSPRLoss.append(model_spr_loss.item())
-            opt_info.tdAbsErr.extend(td_abs_errors[::8].numpy())  # Downsample.
+            if i + 1 < self.updates_per_optimize:
+                # Prefetch the next batch; sampling overlaps the update
+                # kernels still draining from backward and the step below.
+                sample_future = self._sample_executor.submit(
+                    self.replay_buffer.sample_batch, self.batch_size)
+            self.optimizer.step()
+            # Keep tensors as-is here; .item()/.numpy() force a host sync per
+            # update, so defer the conversions to a single flush below.
+            opt_info.loss.append(loss.detach())
+            opt_info.gradNorm.append(torch.as_tensor(grad_norm))  # grad_norm is a float sometimes, so wrap in tensor
+            opt_info.modelRLLoss.append(model_rl_loss.detach())
+            opt_info.RewardLoss.append(reward_loss.detach())
+            opt_info.modelGradNorm.append(torch.as_tensor(model_grad_norm))
+            opt_info.SPRLoss.append(spr_loss.detach())
+            opt_info.ModelSPRLoss.append(model_spr_loss.detach())
+            opt_info.tdAbsErr.append(td_abs_errors[::8].detach())  # Downsample.
             self.update_counter += 1
             if self.update_counter % self.target_update_interval == 0:
                 self.agent.update_target(self.target_update_tau)
+            if i + 1 < self.updates_per_optimize and self._target_stream is not None:
+                # Precompute the next batch's targets on a side stream now
+                # that step/update_target have fixed the weights the next
+                # update would use; the forward runs under the optimizer
+                # kernels still draining on the default stream.
+                next_samples = sample_future.result()
+                # The side stream must see the step/update_target writes
+                # enqueued on the default stream above.
+                self._target_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(self._target_stream):
+                    next_targets = self.compute_targets(next_samples)
+        if opt_info.loss:
+            # One host sync for the whole batch of updates.
+            for field in ("loss", "gradNorm", "modelRLLoss", "RewardLoss",
+                          "modelGradNorm", "SPRLoss", "ModelSPRLoss"):
+                values = getattr(opt_info, field)
+                values[:] = [v.item() for v in values]
+            opt_info.tdAbsErr[:] = torch.cat(opt_info.tdAbsErr).numpy()
         self.update_itr_hyperparams(itr)
         return opt_info
 
-    def dqn_rl_loss(self, qs, samples, index):
+    def dqn_rl_loss(self, qs, samples, index, target_qs=None, next_qs=None):
         """
         Computes the Q-learning loss, based on: 0.5 * (Q - target_Q) ^ 2.
         Implements regular DQN or Double-DQN for computing target_Q values
@@ -186,100 +296,120 @@ class SPRCategoricalDQN(CategoricalDQN):
             invalid.  This case is not supported here currently.
         """
         q = select_at_indexes(samples.all_action[index+1], qs).cpu()
-        with torch.no_grad():
-            target_qs = self.agent.target(samples.all_observation[index + self.n_step_return],
-                                          samples.all_action[index + self.n_step_return],
-                                          samples.all_reward[index + self.n_step_return])  # [B,A,P']
+        with torch.no_grad(), self.autocast():
+            if target_qs is None:
+                target_qs = self.agent.target(samples.all_observation[index + self.n_step_return],
+                                              samples.all_action[index + self.n_step_return],
+                                              samples.all_reward[index + self.n_step_return])  # [B,A,P']
             if self.double_dqn:
-                next_qs = self.agent(samples.all_observation[index + self.n_step_return],
-                                     samples.all_action[index + self.n_step_return],
-                                     samples.all_reward[index + self.n_step_return])  # [B,A,P']
+                if next_qs is None:
+                    next_qs = self.agent(samples.all_observation[index + self.n_step_return],
+                                         samples.all_action[index + self.n_step_return],
+                                         samples.all_reward[index + self.n_step_return])  # [B,A,P']
                 next_a = torch.argmax(next_qs, dim=-1)
                 target_q = select_at_indexes(next_a, target_qs)
             else:
                 target_q = torch.max(target_qs, dim=-1).values
 
-            disc_target_q = (self.discount ** self.n_step_return) * target_q
+            disc_target_q = self._next_z_scale * target_q
             y = samples.return_[index] + (1 - samples.done_n[index].float()) * disc_target_q
 
         delta = y - q
         losses = 0.5 * delta ** 2
-        abs_delta = abs(delta)
+        abs_delta = delta.abs()
         if self.delta_clip > 0:  # Huber loss.
             b = self.delta_clip * (abs_delta - self.delta_clip / 2)
             losses = torch.where(abs_delta <= self.delta_clip, losses, b)
         td_abs_errors = abs_delta.detach()
         if self.delta_clip > 0:
             td_abs_errors = torch.clamp(td_abs_errors, 0, self.delta_clip)
-        return losses, td_abs_errors
+        return losses.float(), td_abs_errors.float()
 
-    def dist_rl_loss(self, log_pred_ps, samples, index):
-        delta_z = (self.V_max - self.V_min) / (self.agent.n_atoms - 1)
-        z = torch.linspace(self.V_min, self.V_max, self.agent.n_atoms)
+    def dist_rl_loss(self, log_pred_ps, samples, index, target_ps=None,
+                     next_ps=None):
+        delta_z = self._delta_z
+        z = self._z
         # Make 2-D tensor of contracted z_domain for each data point,
         # with zeros where next value should not be added.
-        next_z = z * (self.discount ** self.n_step_return)  # [P']
-        next_z = torch.ger(1 - samples.done_n[index].float(), next_z)  # [B,P']
+        next_z = (1 - samples.done_n[index].float()).unsqueeze(-1) \
+            * self._next_z  # [B,P']
         ret = samples.return_[index].unsqueeze(1)  # [B,1]
         next_z = torch.clamp(ret + next_z, self.V_min, self.V_max)  # [B,P']
 
-        z_bc = z.view(1, -1, 1)  # [1,P,1]
-        next_z_bc = next_z.unsqueeze(1)  # [B,1,P']
-        abs_diff_on_delta = abs(next_z_bc - z_bc) / delta_z
-        projection_coeffs = torch.clamp(1 - abs_diff_on_delta, 0, 1)  # Most 0.
-        # projection_coeffs is a 3-D tensor: [B,P,P']
-        # dim-0: independent data entries
-        # dim-1: base_z atoms (remains after projection)
-        # dim-2: next_z atoms (summed in projection)
-
-        with torch.no_grad():
-            target_ps = self.agent.target(samples.all_observation[index + self.n_step_return],
-                                          samples.all_action[index + self.n_step_return],
-                                          samples.all_reward[index + self.n_step_return])  # [B,A,P']
+        with torch.no_grad(), self.autocast():
+            if target_ps is None:
+                target_ps = self.agent.target(samples.all_observation[index + self.n_step_return],
+                                              samples.all_action[index + self.n_step_return],
+                                              samples.all_reward[index + self.n_step_return])  # [B,A,P']
             if self.double_dqn:
-                next_ps = self.agent(samples.all_observation[index + self.n_step_return],
-                                     samples.all_action[index + self.n_step_return],
-                                     samples.all_reward[index + self.n_step_return])  # [B,A,P']
-                next_qs = torch.tensordot(next_ps, z, dims=1)  # [B,A]
+                if next_ps is None:
+                    next_ps = self.agent(samples.all_observation[index + self.n_step_return],
+                                         samples.all_action[index + self.n_step_return],
+                                         samples.all_reward[index + self.n_step_return])  # [B,A,P']
+                next_qs = next_ps.matmul(z)  # [B,A]
                 next_a = torch.argmax(next_qs, dim=-1)  # [B]
             else:
-                target_qs = torch.tensordot(target_ps, z, dims=1)  # [B,A]
+                target_qs = target_ps.matmul(z)  # [B,A]
                 next_a = torch.argmax(target_qs, dim=-1)  # [B]
             target_p_unproj = select_at_indexes(next_a, target_ps)  # [B,P']
-            target_p_unproj = target_p_unproj.unsqueeze(1)  # [B,1,P']
-            target_p = (target_p_unproj * projection_coeffs).sum(-1)  # [B,P]
-        p = select_at_indexes(samples.all_action[index + 1].squeeze(-1),
-                              log_pred_ps.cpu())  # [B,P]
-        # p = torch.clamp(p, EPS, 1)  # NaN-guard.
-        losses = -torch.sum(target_p * p, dim=1)  # Cross-entropy.
-
-        target_p = torch.clamp(target_p, EPS, 1)
-        KL_div = torch.sum(target_p *
-            (torch.log(target_p) - p.detach()), dim=1)
+            target_p = c51_projection(target_p_unproj, next_z, self.V_min,
+                                      delta_z, self.agent.n_atoms)  # [B,P]
+        # head_forward(logits=True) already went through F.log_softmax, so
+        # these are log-probabilities; no clamp/log needed on the online side.
+        log_p = select_at_indexes(samples.all_action[index + 1].squeeze(-1),
+                                  log_pred_ps.cpu())  # [B,P]
+        losses = -torch.sum(target_p * log_p, dim=1)  # Cross-entropy.
+
+        # KL(t||p) = sum t*log(t) + CE(t,p): reuse the cross-entropy
+        # reduction just computed instead of redoing the log_p term.
+        # target_p is a convex combination of probability rows, already in
+        # [0, 1]; only the log needs guarding against exact zeros.
+        KL_div = torch.sum(target_p * torch.log(target_p.clamp_min(EPS)),
+                           dim=1) + losses.detach()
         KL_div = torch.clamp(KL_div, EPS, 1 / EPS)  # Avoid <0 from NaN-guard.
 
-        return losses, KL_div.detach()
+        return losses.float(), KL_div.detach().float()
 
-    def loss(self, samples):
+    def loss(self, samples, target_ps=None):
         """
         Computes the Distributional Q-learning loss, based on projecting the
         discounted rewards + target Q-distribution into the current Q-domain,
         with cross-entropy loss.
 
+        ``target_ps`` takes pre-computed target distributions (see
+        ``compute_targets``); if ``None`` they are computed here.
+
         Returns loss and KL-divergence-errors for use in prioritization.
         """
         if self.model.noisy:
             self.model.head.reset_noise()
         # start = time.time()
-        log_pred_ps, pred_rew, spr_loss, pred_l2_loss\
-            = self.agent(samples.all_observation.to(self.agent.device),
-                         samples.all_action.to(self.agent.device),
-                         samples.all_reward.to(self.agent.device),
-                         train=True)  # [B,A,P]
+        with self.autocast():
+            log_pred_ps, pred_rew, spr_loss, pred_l2_loss\
+                = self.agent(samples.all_observation.to(self.agent.device),
+                             samples.all_action.to(self.agent.device),
+                             samples.all_reward.to(self.agent.device),
+                             train=True)  # [B,A,P]
+
+        n_target_steps = self.n_target_steps
+        if target_ps is None:
+            target_ps = self.compute_targets(samples)
+        if self.double_dqn:
+            # The online argmax forwards are just as redundant as the target
+            # ones; reuse the stacked inputs and run them in one pass.  Unlike
+            # the targets these read the online weights, so they cannot be
+            # precomputed ahead of the optimizer step.
+            target_obs, target_act, target_rew = self.target_inputs(samples)
+            with torch.no_grad(), self.autocast():
+                next_ps = self.agent(target_obs, target_act, target_rew)
+                next_ps = next_ps.view(n_target_steps, -1, *next_ps.shape[1:])
+        else:
+            next_ps = [None] * n_target_steps
 
-        rl_loss, KL = self.rl_loss(log_pred_ps[0], samples, 0)
+        rl_loss, KL = self.rl_loss(log_pred_ps[0], samples, 0, target_ps[0],
+                                   next_ps[0])
         if len(pred_rew) > 0:
-            pred_rew = torch.stack(pred_rew, 0)
+            pred_rew = F.log_softmax(torch.stack(pred_rew, 0), -1)
             with torch.no_grad():
                 reward_target = to_categorical(samples.all_reward[:self.jumps+1].flatten().to(self.agent.device), limit=1).view(*pred_rew.shape)
             reward_loss = -torch.sum(reward_target * pred_rew, 2).mean(0).cpu()
@@ -291,7 +421,9 @@ class SPRCategoricalDQN(CategoricalDQN):
             for i in range(1, self.jumps+1):
                     jump_rl_loss, model_KL = self.rl_loss(log_pred_ps[i],
                                                    samples,
-                                                   i)
+                                                   i,
+                                                   target_ps[i],
+                                                   next_ps[i])
                     model_rl_loss = model_rl_loss + jump_rl_loss
 
         nonterminals = 1. - torch.sign(torch.cumsum(samples.done.to(self.agent.device), 0)).float()
@@ -563,14 +563,16 @@ class SPRCatDqnModel(torch.nn.Module):
             pred_latents.append(latent) #[32, 64, 7, 7] vs [32, 600]
 
             if self.jumps > 0:
+                # Collect raw logits; the caller stacks the jumps and applies
+                # one log_softmax over all of them at once.
                 pred_rew = self.dynamics_model.reward_predictor(pred_latents[0]) #[32, 3]
-                pred_reward.append(F.log_softmax(pred_rew, -1))
+                pred_reward.append(pred_rew)
 
                 for j in range(1, self.jumps + 1):
                     latent, pred_rew = self.step(latent, prev_action[j])
 
                     pred_rew = pred_rew[:observation.shape[1]]
-                    pred_reward.append(F.log_softmax(pred_rew, -1))
+                    pred_reward.append(pred_rew)
 
                     if isinstance(latent, tuple):
                         state, latent = latent
@@ -1204,13 +1206,9 @@ class TransitionModel(nn.Module):
         # x = [32, 64, 7, 7]
         # action = [32]
 
-        batch_range = torch.arange(action.shape[0], device=action.device)
-        action_onehot = torch.zeros(action.shape[0],
-                                    self.num_actions,
-                                    x.shape[-2],
-                                    x.shape[-1],
-                                    device=action.device)
-        action_onehot[batch_range, action, :, :] = 1
+        action_onehot = F.one_hot(action, self.num_actions).to(x.dtype)
+        action_onehot = action_onehot[:, :, None, None].expand(
+            -1, -1, x.shape[-2], x.shape[-1])
         stacked_image = torch.cat([x, action_onehot], 1)
         next_state = self.network(stacked_image)
 
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
+import math
+
+import numpy as np
 import torch
 
 from rlpyt.replays.sequence.prioritized import SamplesFromReplayPri
@@ -38,6 +41,129 @@ def samples_to_buffer(observation, action, reward, done, policy_probs, value, pr
     else:
         return samples
 
+class BlockedSumTree:
+    """Sum-tree over the [T,B] priority grid with fan-out ``fanout`` instead
+    of 2, so the children of each node sit contiguously and every level of an
+    update or a descent is one vectorized numpy op over the whole batch.
+    Depth drops from log2(N) to log16(N), which is where the per-update
+    priority-write time goes for large buffers.  Single-process use only: the
+    shared-memory coordination of rlpyt's AsyncSumTree is not replicated,
+    which matches how these buffers are driven in this repo.
+    """
+
+    def __init__(self, T, B, off_backward, off_forward,
+                 default_value=1, fanout=16):
+        self.T = T
+        self.B = B
+        self.size = T * B
+        self.off_backward = off_backward
+        self.off_forward = off_forward
+        self.default_value = default_value
+        self.fanout = fanout
+        self.tree_depth = max(1, int(math.ceil(math.log(self.size, fanout))))
+        # Nodes above the leaves: 1 + K + ... + K^(D-1).
+        self.low_idx = (fanout ** self.tree_depth - 1) // (fanout - 1)
+        self.tree = np.zeros(self.low_idx + fanout ** self.tree_depth)
+        self.priorities = self.tree[self.low_idx:self.low_idx + self.size
+                                    ].reshape(T, B)
+        self.reset()
+
+    def reset(self):
+        self.tree.fill(0)
+        self.t = 0
+        self._initial_wrap_guard = True
+        self.prev_tree_idxs = None
+        self._sampled_unique = False
+
+    def advance(self, T, priorities=None):
+        """Cursor advances by T: default-priority the samples leaving the
+        off region behind the cursor, zero the region around the new one."""
+        if priorities is not None:
+            raise NotImplementedError  # input_priorities unused in this repo.
+        t, b, f = self.t, self.off_backward, self.off_forward
+        if self._initial_wrap_guard:
+            low_on_t = max(f, t - b)  # Don't wrap back to end, and off_forward.
+            high_on_t = max(low_on_t, t + T - b)
+            self._write_rows(low_on_t, high_on_t, self.default_value)
+            if t + T - b >= f:  # Next low_on_t >= f.
+                self._initial_wrap_guard = False
+        else:
+            self._write_rows_circular((t - b) % self.T, T, self.default_value)
+            self._write_rows_circular((t + T - b) % self.T, b + f, 0)
+        self.t = (t + T) % self.T
+
+    def sample(self, n, unique=False):
+        """Get `n` samples, with replacement (default) or without."""
+        self._sampled_unique = unique
+        if unique:
+            tree_idxs = np.array([], dtype=np.int64)
+            for _ in range(100):
+                new_idxs, _ = self.find(np.random.rand(n - len(tree_idxs)))
+                tree_idxs = np.unique(np.concatenate([tree_idxs, new_idxs]))
+                if len(tree_idxs) >= n:
+                    break
+            else:
+                raise RuntimeError(
+                    "After 100 tries, unable to get unique indexes.")
+        else:
+            tree_idxs, _ = self.find(np.random.rand(n))
+        self.prev_tree_idxs = tree_idxs
+        priorities = self.tree[tree_idxs]  # Raw leaf values, like SumTree.
+        T_idxs, B_idxs = np.divmod(tree_idxs - self.low_idx, self.B)
+        return (T_idxs, B_idxs), priorities
+
+    def update_batch_priorities(self, priorities):
+        priorities = np.asarray(priorities)
+        if not self._sampled_unique:  # Must remove duplicates.
+            self.prev_tree_idxs, unique_idxs = np.unique(
+                self.prev_tree_idxs, return_index=True)
+            priorities = priorities[unique_idxs]
+        self.reconstruct(self.prev_tree_idxs, priorities)
+
+    # Helpers.
+
+    def reconstruct(self, tree_idxs, values):
+        diffs = values - self.tree[tree_idxs]
+        self.tree[tree_idxs] = values
+        self.propagate_diffs(tree_idxs, diffs)
+
+    def propagate_diffs(self, tree_idxs, diffs):
+        for _ in range(self.tree_depth):
+            tree_idxs = (tree_idxs - 1) // self.fanout  # Rise a level.
+            np.add.at(self.tree, tree_idxs, diffs)
+
+    def find(self, random_values):
+        """Param random_values: numpy array of floats in range [0, 1]."""
+        K = self.fanout
+        random_values = self.tree[0] * random_values  # Scale to sum.
+        tree_idxs = np.zeros(len(random_values), dtype=np.int64)
+        rows = np.arange(len(random_values))
+        offsets = np.arange(K)
+        for _ in range(self.tree_depth):
+            child_base = K * tree_idxs + 1
+            cumsums = np.cumsum(self.tree[child_base[:, None] + offsets],
+                                axis=1)  # [n,K]
+            j = (random_values[:, None] > cumsums).sum(axis=1)
+            j = np.minimum(j, K - 1)  # Roundoff guard.
+            random_values = random_values - np.where(
+                j > 0, cumsums[rows, j - 1], 0.)
+            tree_idxs = child_base + j
+        return tree_idxs, random_values
+
+    def _write_rows(self, low_t, high_t, value):
+        if high_t <= low_t:
+            return
+        tree_idxs = np.arange(low_t * self.B + self.low_idx,
+                              high_t * self.B + self.low_idx)
+        self.reconstruct(tree_idxs, np.full(len(tree_idxs), float(value)))
+
+    def _write_rows_circular(self, low_t, length, value):
+        high_t = low_t + length
+        self._write_rows(low_t, min(high_t, self.T), value)
+        if high_t > self.T:  # Wrap.
+            self._write_rows(0, high_t - self.T, value)
+
+
 class AsyncUniformSequenceReplayFrameBufferExtended(AsyncUniformSequenceReplayFrameBuffer):
     """
     Extends AsyncPrioritizedSequenceReplayFrameBuffer to return policy_logits and values too during sampling.
@@ -86,6 +212,21 @@ class AsyncPrioritizedSequenceReplayFrameBufferExtended(AsyncPrioritizedSequence
     """
     Extends AsyncPrioritizedSequenceReplayFrameBuffer to return policy_logits and values too during sampling.
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Swap the binary sum-tree for the blocked variant; fewer, wider
+        # levels per priority update and per sampling descent.  Sampled
+        # T_idxs are sequence starts, so the exclusion window behind the
+        # write cursor must cover the whole extracted sequence, not just
+        # the n-step return.
+        self.priority_tree = BlockedSumTree(
+            T=self.T,
+            B=self.B,
+            off_backward=self.off_backward + self.batch_T,
+            off_forward=self.off_forward,
+            default_value=self.default_priority ** self.alpha,
+        )
+
     def sample_batch(self, batch_B):
         while True:
             try:
@@ -88,6 +88,7 @@ def set_config(args, game):
     config["algo"]["distributional"] = args.distributional
     config["algo"]["delta_clip"] = args.delta_clip
     config["algo"]["prioritized_replay"] = args.prioritized_replay
+    config["algo"]["amp"] = args.amp
 
     # new new arguments
     config["model"]["pred_hidden_ratio"] = args.pred_hidden_ratio